@@ -2,8 +2,22 @@ import streamlit as st
 import os
 import tempfile
 import re
-from difflib import SequenceMatcher
-from langchain_community.document_loaders import TextLoader, PyPDFLoader, UnstructuredPowerPointLoader
+import bisect
+import contextlib
+import hashlib
+import heapq
+import itertools
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import time
+from rapidfuzz import fuzz, process
+import numpy as np
+import torch
+import faiss
+import pypdfium2 as pdfium
+from sentence_transformers import SentenceTransformer
+from langchain_community.document_loaders import TextLoader, UnstructuredPowerPointLoader
 
 # ----------------- CONFIG -----------------
 st.set_page_config(
@@ -13,11 +27,33 @@ st.set_page_config(
 )
 st.title("🤖 Chat with PDF (GPT Style Conversation)")
 
+EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBED_DIM = 384
+EMBED_BATCH_SIZE = 128
+INDEX_BATCH_LINES = 512  # lines encoded per call while a file's pages stream in
+EMB_CACHE_DIR = ".emb_cache"
+EMB_CACHE_MAX_FILES = 64
+EMB_CACHE_TMP_MAX_AGE = 3600  # seconds before an orphaned temp file from a failed save is removed
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 64
+HNSW_EF_SEARCH = 64
+QA_CACHE_THRESHOLD = 0.85  # cosine similarity for treating questions as paraphrases
+QA_CACHE_TTL = 300  # seconds since last use
+QA_CACHE_MAX = 128
+
 # ----------------- SESSION STATE -----------------
-if "docs_text" not in st.session_state:
-    st.session_state.docs_text = ""
+if "doc_lines" not in st.session_state:
+    st.session_state.doc_lines = []
+    st.session_state.lines_lower = None
+    st.session_state.docs_key = None
+    st.session_state.keyword_index = None
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
+if "doc_index" not in st.session_state:
+    st.session_state.doc_index = None
+if "qa_cache_entries" not in st.session_state:
+    st.session_state.qa_cache_entries = []
+    st.session_state.qa_cache_index = faiss.IndexFlatIP(EMBED_DIM)
 
 # ----------------- SIDEBAR -----------------
 with st.sidebar:
@@ -30,51 +66,423 @@ with st.sidebar:
     st.markdown("---")
     st.info("Offline mode: No API key needed ✅")
     if st.button("Clear History & Documents"):
-        st.session_state.docs_text = ""
+        st.session_state.doc_lines = []
+        st.session_state.lines_lower = None
+        st.session_state.docs_key = None
+        st.session_state.keyword_index = None
         st.session_state.chat_history = []
+        st.session_state.doc_index = None
+        st.session_state.qa_cache_entries = []
+        st.session_state.qa_cache_index = faiss.IndexFlatIP(EMBED_DIM)
 
 # ----------------- HELPER FUNCTIONS -----------------
+_PAGENUM = re.compile(r'\b\d{1,4}\b')
+_SENT = re.compile(r'(?<=[.!?]) +')
+_WORD = re.compile(r'\w+')
+
 def remove_page_numbers(text):
     """Remove isolated numbers (likely page numbers)."""
-    return re.sub(r'\b\d{1,4}\b', '', text)
+    return _PAGENUM.sub('', text)
 
-def similarity(a, b):
-    return SequenceMatcher(None, a.lower(), b.lower()).ratio()
+@st.cache_resource(show_spinner=False)
+def _pdfium_lock():
+    """Process-wide lock for PDFium, which is not thread-safe even across separate documents.
 
-def find_relevant_chunks(question, text, max_chunks=5, max_lines=40):
-    """Find most relevant chunks of text for the question."""
-    lines = text.split("\n")
-    chunks = []
-    for i, line in enumerate(lines):
-        score = similarity(question, line)
-        chunks.append((score, i))
-    chunks = sorted(chunks, key=lambda x: x[0], reverse=True)
-    selected_chunks = []
-    used_indices = set()
-    for score, idx in chunks[:max_chunks]:
-        if idx in used_indices:
+    Cached as a resource because the script (and any module-level lock) is re-executed on
+    every rerun and shared by all sessions' threads.
+    """
+    return threading.Lock()
+
+def iter_pdf_pages(data):
+    """Yield the text of each PDF page straight from the uploaded bytes, one page at a time.
+
+    Every PDFium call runs under _pdfium_lock(); the lock is released between pages so
+    other uploads can be encoded meanwhile.
+    """
+    lock = _pdfium_lock()
+    with lock:
+        pdf = pdfium.PdfDocument(data)
+        n_pages = len(pdf)
+    try:
+        for i in range(n_pages):
+            with lock:
+                page = pdf[i]
+                try:
+                    textpage = page.get_textpage()
+                    try:
+                        text = textpage.get_text_range().replace("\r\n", "\n")
+                    finally:
+                        textpage.close()
+                finally:
+                    page.close()
+            yield text
+    finally:
+        with lock:
+            pdf.close()
+
+def load_with_loader(f):
+    """Load a TXT / PPTX upload through its LangChain loader, which needs a file path."""
+    with tempfile.NamedTemporaryFile(delete=False) as tmp:
+        tmp.write(f.getvalue())
+        path = tmp.name
+    try:
+        if f.name.endswith(".txt"):
+            loader = TextLoader(path, encoding="utf-8")
+        else:
+            loader = UnstructuredPowerPointLoader(path)
+        return [d.page_content for d in loader.load()]
+    finally:
+        os.unlink(path)
+
+def iter_file_pages(f):
+    """Yield cleaned page texts from one supported upload, lazily."""
+    if f.name.endswith(".pdf"):
+        pages = iter_pdf_pages(f.getvalue())
+    elif f.name.endswith((".txt", ".pptx")):
+        pages = load_with_loader(f)
+    else:
+        return
+    for page in pages:
+        yield remove_page_numbers(page)
+
+@st.cache_resource(show_spinner=False)
+def load_embedder():
+    """Load the sentence-transformer once per server process (None if unavailable offline)."""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    try:
+        model = SentenceTransformer(EMBED_MODEL, device=device)
+    except OSError:
+        return None
+    if device == "cuda":
+        model.half()
+    return model
+
+def encode_texts(model, texts):
+    """Normalized float32 embeddings for FAISS, encoded in large batches."""
+    embeds = model.encode(
+        texts,
+        batch_size=EMBED_BATCH_SIZE,
+        show_progress_bar=False,
+        normalize_embeddings=True,
+        convert_to_numpy=True
+    )
+    return embeds.astype(np.float32, copy=False)
+
+def _mtime(path):
+    """Modification time of a cache file, or 0 if another session already removed it."""
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0.0
+
+def _prune_emb_cache():
+    """Keep only the EMB_CACHE_MAX_FILES most recently used embedding and index cache files.
+
+    The cache directory is shared by every session, so files may vanish at any point;
+    those are treated as already removed.
+    """
+    if not os.path.isdir(EMB_CACHE_DIR):
+        return
+    names = os.listdir(EMB_CACHE_DIR)
+    for suffix in (".npz", ".faiss"):
+        paths = [os.path.join(EMB_CACHE_DIR, name) for name in names if name.endswith(suffix)]
+        if len(paths) <= EMB_CACHE_MAX_FILES:
             continue
-        chunk = lines[idx:idx+max_lines]
-        selected_chunks.append("\n".join(chunk))
-        used_indices.update(range(idx, idx+max_lines))
-    return "\n\n".join(selected_chunks)
+        keep = set(heapq.nlargest(EMB_CACHE_MAX_FILES, paths, key=_mtime))
+        for path in paths:
+            if path not in keep:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+    # Temp files still being written are recent; old ones were left by a crashed save
+    now = time.time()
+    for name in names:
+        path = os.path.join(EMB_CACHE_DIR, name)
+        if name.endswith(".tmp") and now - _mtime(path) > EMB_CACHE_TMP_MAX_AGE:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+def _write_cache_file(path, write):
+    """Write a cache file through write(file_obj) into a temp file, then rename it into place.
+
+    Readers in other sessions never see a partial file, and the temp file is removed if
+    the write fails.
+    """
+    os.makedirs(EMB_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=EMB_CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            write(out)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+def file_digest(f):
+    """Content hash of an upload, salted with the model name since cached vectors depend on it."""
+    return hashlib.sha256(EMBED_MODEL.encode() + f.getvalue()).hexdigest()
+
+def docs_digest(files):
+    """Per-file digests plus a single key for the whole upload set."""
+    digests = [file_digest(f) for f in files]
+    return digests, hashlib.sha256("".join(digests).encode()).hexdigest()
 
-def generate_gpt_style_answer(question, context):
+def _read_emb_cache(digest, with_vecs=True):
+    """(lines, vectors) from a file's embedding cache entry, or None on a miss.
+
+    Vectors are only read when with_vecs is set. An entry pruned by another session
+    in the meantime is just a miss.
+    """
+    cache_path = os.path.join(EMB_CACHE_DIR, f"{digest}.npz")
+    try:
+        os.utime(cache_path)  # mark as recently used
+        with np.load(cache_path) as cached:
+            lines = cached["text"].tobytes().decode("utf-8").split("\n") if int(cached["n_lines"]) else []
+            return lines, cached["vecs"] if with_vecs else None
+    except FileNotFoundError:
+        return None
+
+def _write_emb_cache(digest, lines, vecs):
+    """Store a file's lines (as UTF-8 bytes) and vectors in its embedding cache entry."""
+    # Lines always come from str.split("\n"), so the joined text round-trips exactly
+    text = np.frombuffer("\n".join(lines).encode("utf-8"), dtype=np.uint8)
+    _write_cache_file(
+        os.path.join(EMB_CACHE_DIR, f"{digest}.npz"),
+        lambda out: np.savez(out, text=text, n_lines=np.array(len(lines)), vecs=vecs)
+    )
+
+def _load_saved_index(digests, docs_key):
+    """Memory-map a previously built index for this upload set, returning (lines, index) or None."""
+    index_path = os.path.join(EMB_CACHE_DIR, f"{docs_key}.faiss")
+    if not os.path.exists(index_path):
+        return None
+    cached = [_read_emb_cache(digest, with_vecs=False) for digest in digests]
+    if any(entry is None for entry in cached):
+        return None
+    file_lines = [lines for lines, _ in cached]
+    try:
+        os.utime(index_path)
+        # IO_FLAG_MMAP only maps IVF inverted lists; MMAP_IFC also maps the flat vector
+        # storage behind HNSW, so it pages in on demand instead of being read into RAM
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP_IFC)
+    except (FileNotFoundError, RuntimeError):
+        # Pruned by another session in the meantime (faiss reports missing files as RuntimeError)
+        return None
+    lines = list(itertools.chain.from_iterable(file_lines))
+    if index.ntotal != len(lines):
+        # Stale or mismatched file: its ids would slice the wrong lines
+        return None
+    index.hnsw.efSearch = HNSW_EF_SEARCH
+    return lines, index
+
+def _save_index(index, docs_key):
+    """Write the index next to the embedding cache."""
+    _write_cache_file(
+        os.path.join(EMB_CACHE_DIR, f"{docs_key}.faiss"),
+        lambda out: faiss.write_index(index, faiss.PyCallbackIOWriter(out.write))
+    )
+
+def embed_file(f, digest, model):
+    """Return (lines, vectors) for one upload.
+
+    Pages are streamed and encoded in batches. Results are cached on disk keyed by the
+    file's content hash, so re-uploading the same file skips parsing and encoding.
+    """
+    cached = _read_emb_cache(digest)
+    if cached is not None:
+        return cached
+
+    lines = []
+    batches = []
+    pending = []
+    for page in iter_file_pages(f):
+        page_lines = page.split("\n")
+        lines.extend(page_lines)
+        pending.extend(page_lines)
+        if len(pending) >= INDEX_BATCH_LINES:
+            batches.append(encode_texts(model, pending))
+            pending = []
+    if pending:
+        batches.append(encode_texts(model, pending))
+    # Files without any lines are cached too, so saved indexes covering them stay reusable
+    vecs = np.vstack(batches) if batches else np.empty((0, EMBED_DIM), dtype=np.float32)
+    _write_emb_cache(digest, lines, vecs)
+    return lines, vecs
+
+def _load_one(f, digest, model):
+    """(lines, vectors) for one upload; vectors are None when the model is unavailable."""
+    if model is None:
+        return [line for page in iter_file_pages(f) for line in page.split("\n")], None
+    return embed_file(f, digest, model)
+
+def build_line_index(files, digests, docs_key):
+    """Split uploads into lines and embed them into an HNSW cosine-similarity index.
+
+    Each file's vectors are added (in upload order) as soon as that file is done, while
+    later files are still loading. An index already built for the same upload set is
+    memory-mapped from disk instead. Returns (lines, index); the index is None when the embedding model is unavailable.
+    """
+    model = load_embedder()
+    if model is not None:
+        saved = _load_saved_index(digests, docs_key)
+        if saved is not None:
+            return saved
+    # Encoding and the TXT / PPTX loaders overlap across files; PDFium calls are serialized
+    # by _pdfium_lock() inside iter_pdf_pages
+    index = new_line_index() if model is not None else None
+    lines = []
+    with ThreadPoolExecutor(max_workers=min(8, len(files))) as ex:
+        futures = [ex.submit(_load_one, f, digest, model) for f, digest in zip(files, digests)]
+        for future in futures:
+            file_lines, vecs = future.result()
+            lines.extend(file_lines)
+            if index is not None and len(vecs):
+                index.add(vecs)
+    if index is None:
+        return lines, None
+    _save_index(index, docs_key)
+    _prune_emb_cache()
+    return lines, index
+
+def new_line_index():
+    """Empty HNSW graph index over normalized vectors (inner product = cosine)."""
+    index = faiss.IndexHNSWFlat(EMBED_DIM, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    index.hnsw.efSearch = HNSW_EF_SEARCH
+    return index
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def embed_question(question):
+    """Normalized embedding for a question, cached across reruns by content."""
+    return encode_texts(load_embedder(), [question])
+
+def _rebuild_qa_cache(entries):
+    """Replace the answer cache with the given entries and re-index their vectors."""
+    index = faiss.IndexFlatIP(EMBED_DIM)
+    if entries:
+        index.add(np.vstack([e["vec"] for e in entries]))
+    st.session_state.qa_cache_entries = entries
+    st.session_state.qa_cache_index = index
+
+def cached_answer(qv):
+    """Return the stored answer for a previously asked (or paraphrased) question, or None."""
+    now = time.time()
+    entries = st.session_state.qa_cache_entries
+    live = [e for e in entries if now - e["last_used"] < QA_CACHE_TTL]
+    if len(live) != len(entries):
+        _rebuild_qa_cache(live)
+    if not live:
+        return None
+    scores, ids = st.session_state.qa_cache_index.search(qv, 1)
+    if scores[0][0] < QA_CACHE_THRESHOLD:
+        return None
+    entry = live[ids[0][0]]
+    entry["last_used"] = now
+    return entry["answer"]
+
+def remember_answer(qv, answer):
+    """Add an answer to the cache, evicting the least recently used entry when full."""
+    entries = st.session_state.qa_cache_entries
+    if len(entries) >= QA_CACHE_MAX:
+        lru = min(range(len(entries)), key=lambda i: entries[i]["last_used"])
+        _rebuild_qa_cache(entries[:lru] + entries[lru+1:])
+    st.session_state.qa_cache_entries.append({"vec": qv, "answer": answer, "last_used": time.time()})
+    st.session_state.qa_cache_index.add(qv)
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def find_relevant_chunks(question, docs_key, _lines, _index=None, _lines_lower=None, max_chunks=5, max_lines=40):
+    """Find the most relevant chunks for the question as non-overlapping (start, end) line
+    windows, best first.
+
+    Uses the line embedding index when available, otherwise falls back to
+    RapidFuzz token-sort similarity over every line (lowercased once at load time
+    as _lines_lower). Results are cached on (question, docs_key); the underscore
+    arguments are not hashed by Streamlit.
+    """
+    lines = _lines
+    if _index is not None:
+        _, ids = _index.search(embed_question(question), max_chunks)
+        top = [int(i) for i in ids[0] if i >= 0]
+    else:
+        lines_lower = _lines_lower
+        if lines_lower is None:
+            lines_lower = [line.lower() for line in lines]
+        # token_set_ratio scores any line whose words are a subset of the question (e.g. just
+        # "the") at 100; token_sort_ratio penalises the length gap like SequenceMatcher did
+        matches = process.extract(question.lower(), lines_lower, scorer=fuzz.token_sort_ratio, limit=max_chunks)
+        top = [idx for _, _, idx in matches]
+    windows = []
+    starts = []  # sorted starts of the selected [start, start+max_lines) windows
+    for idx in top:
+        # All windows have the same length, so only the nearest neighbours can overlap
+        pos = bisect.bisect_left(starts, idx)
+        if pos > 0 and starts[pos-1] + max_lines > idx:
+            continue
+        if pos < len(starts) and starts[pos] < idx + max_lines:
+            continue
+        starts.insert(pos, idx)
+        windows.append((idx, min(idx + max_lines, len(lines))))
+    return windows
+
+def build_keyword_index(lines):
+    """Index the document's lines by word, once per document set.
+
+    Returns a word -> sorted line ids posting list and the sorted vocabulary used for
+    prefix lookups.
+    """
+    postings = defaultdict(list)
+    for i, line in enumerate(lines):
+        for token in set(_WORD.findall(line.lower())):
+            postings[token].append(i)
+    return {"postings": dict(postings), "vocab": sorted(postings)}
+
+def keyword_tokens(keywords, keyword_index):
+    """Vocabulary words starting with any keyword, so "model" also finds "models"."""
+    vocab = keyword_index["vocab"]
+    tokens = []
+    for kw in keywords:
+        j = bisect.bisect_left(vocab, kw)
+        while j < len(vocab) and vocab[j].startswith(kw):
+            tokens.append(vocab[j])
+            j += 1
+    return tokens
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def generate_gpt_style_answer(question, docs_key, windows, _lines=None, _keyword_index=None):
     """
     Generate clean GPT-style answers:
     - Self-contained
     - Max 6 points
     - Covers model evaluation and improvement properly
-    """
-    context = remove_page_numbers(context)
-    sentences = re.split(r'(?<=[.!?]) +', context) if context.strip() else []
 
+    Points are the keyword-matching sentences of each retrieved line window, in window
+    rank order. Cached on (question, docs_key, windows).
+    """
     # Extract relevant sentences based on keywords
-    keywords = [w.lower() for w in question.split() if len(w) > 3]
-    relevant_sentences = [
-        s.strip() for s in sentences 
-        if any(kw in s.lower() for kw in keywords) and len(s.strip()) > 10
-    ]
+    keywords = {w for w in _WORD.findall(question.lower()) if len(w) > 3}
+    relevant_sentences = []
+    if _keyword_index is not None and windows and keywords:
+        postings = _keyword_index["postings"]
+        tokens = keyword_tokens(keywords, _keyword_index)
+        has_keyword = re.compile(r"\b(?:" + "|".join(re.escape(kw) for kw in sorted(keywords)) + ")")
+        for start, end in windows:
+            # Posting lists are sorted, so each one is sliced to this window by bisection
+            hit_lines = set()
+            for token in tokens:
+                ids = postings[token]
+                hit_lines.update(ids[bisect.bisect_left(ids, start):bisect.bisect_left(ids, end)])
+            if not hit_lines:
+                continue
+            # Split only this window's text, so each sentence is already clipped to it;
+            # sentences are split on spaces only, so each starts on the line the previous ended
+            line = start
+            for sentence in _SENT.split("\n".join(_lines[start:end])):
+                last = line + sentence.count("\n")
+                if any(i in hit_lines for i in range(line, last + 1)) and has_keyword.search(sentence.lower()):
+                    sentence = sentence.strip()
+                    if len(sentence) > 10:
+                        relevant_sentences.append(sentence)
+                line = last
 
     # Fallback points for "Model Evaluation and Improvement"
     fallback_points = [
@@ -96,29 +504,20 @@ def generate_gpt_style_answer(question, context):
 
 # ----------------- LOAD DOCUMENTS -----------------
 if files:
-    with st.spinner("Processing files..."):
-        all_text = []
-        for f in files:
-            with tempfile.NamedTemporaryFile(delete=False) as tmp:
-                tmp.write(f.getvalue())
-                path = tmp.name
-            try:
-                if f.name.endswith(".pdf"):
-                    loader = PyPDFLoader(path)
-                elif f.name.endswith(".txt"):
-                    loader = TextLoader(path, encoding="utf-8")
-                elif f.name.endswith(".pptx"):
-                    loader = UnstructuredPowerPointLoader(path)
-                else:
-                    continue
-                docs = loader.load()
-                for d in docs:
-                    text = remove_page_numbers(d.page_content)
-                    all_text.append(text)
-            finally:
-                os.unlink(path)
-        st.session_state.docs_text = "\n".join(all_text)
-        st.success(f"✅ {len(files)} document(s) loaded successfully!")
+    digests, docs_key = docs_digest(files)
+    # Streamlit reruns the script on every interaction; only rebuild when the uploads change
+    if docs_key != st.session_state.docs_key:
+        with st.spinner("Processing files..."):
+            lines, doc_index = build_line_index(files, digests, docs_key)
+            # Cached answers were built from the previous documents
+            _rebuild_qa_cache([])
+            st.session_state.doc_lines = lines
+            # Only the string-similarity fallback needs lowercased lines
+            st.session_state.lines_lower = [line.lower() for line in lines] if doc_index is None else None
+            st.session_state.doc_index = doc_index
+            st.session_state.keyword_index = build_keyword_index(lines)
+            st.session_state.docs_key = docs_key
+    st.success(f"✅ {len(files)} document(s) loaded successfully!")
 
 # ----------------- CHAT INTERFACE -----------------
 st.header("❓ Ask a Question")
@@ -126,8 +525,25 @@ question = st.text_input("Type your question here:")
 
 if st.button("Send") and question:
     with st.spinner("Generating answer..."):
-        context_chunk = find_relevant_chunks(question, st.session_state.docs_text) if st.session_state.docs_text else ""
-        answer = generate_gpt_style_answer(question, context_chunk)
+        qv = embed_question(question) if load_embedder() is not None else None
+        answer = cached_answer(qv) if qv is not None else None
+        if answer is None:
+            windows = find_relevant_chunks(
+                question,
+                st.session_state.docs_key,
+                st.session_state.doc_lines,
+                st.session_state.doc_index,
+                st.session_state.lines_lower
+            ) if st.session_state.doc_lines else []
+            answer = generate_gpt_style_answer(
+                question,
+                st.session_state.docs_key,
+                windows,
+                st.session_state.doc_lines,
+                st.session_state.keyword_index
+            )
+            if qv is not None:
+                remember_answer(qv, answer)
         st.session_state.chat_history.append({"question": question, "answer": answer})
 
 # ----------------- DISPLAY CHAT HISTORY -----------------